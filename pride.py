@@ -37,17 +37,29 @@ SOFTWARE.
 from picographics import PicoGraphics, DISPLAY_TUFTY_2040, PEN_P4
 from pimoroni import Button
 from machine import ADC, Pin
+from array import array
 import gc
 import time
 import math
+import micropython
 import qrcode
 
+# Looked up on every frame, so save going through the module each time
+_ticks_ms = time.ticks_ms
+_ticks_diff = time.ticks_diff
+_sleep_ms = time.sleep_ms
+
 # Turn on the LUX diode and start reading the analogue value.
 # We use this for screen brightness
 lux_pwr = Pin(27, Pin.OUT)
 lux_pwr.value(1)
 lux = ADC(26)
 
+# The light level only changes slowly, so read it a few times a second,
+# smooth it, and step the backlight between a few fixed levels.
+LUX_POLL_MS = 250
+BACKLIGHT_LEVELS = [0.5 + (level / 14) for level in range(8)]
+
 # Initialize the screen. We are using the 4 bit colour mode
 # since we can and 3:3:2 RGB was causing memory to run out :(
 display = PicoGraphics(DISPLAY_TUFTY_2040, pen_type=PEN_P4)
@@ -62,19 +74,94 @@ button_c = Button(9, invert=False)
 button_up = Button(22, invert=False)
 button_down = Button(6, invert=False)
 
+# Buttons only change at human speed so don't read them every frame.
+BUTTON_POLL_MS = 16
+
+# How long to wait between checking the buttons while paused.
+PAUSE_SLEEP_MS = 30
+
 # How many columns we want to split the flag into.
 COLS = 12 
 COL_WIDTH = WIDTH // COLS
 
-# We want two cycles of the sin wave so a nice constant.
-FOUR_PI = 12.566 
+# Where the flag sits on the screen and how far the wave moves it.
+FLAG_TOP = 30
+FLAG_HEIGHT = 180
+AMPLITUDE = 15
+
+# The wave never leaves this band, so only it needs clearing each frame.
+BAND_TOP = FLAG_TOP - AMPLITUDE - 1
+BAND_HEIGHT = FLAG_HEIGHT + 2 * (AMPLITUDE + 1)
+
+# We want two cycles of the sin wave across the flag.
+CYCLES = 2
 
 # Make it so that it moves less towards the "flag pole"
 WEIGHTS = [0.0] + [min(1.0, (i / COLS) + 0.2) for i in range(COLS)]
+WEIGHTS_Q8 = array("h", [int(weight * 256) for weight in WEIGHTS])
+
+# One full cycle of the wave in 256 steps, so the render path can index
+# it with integers instead of calling math.sin on a chip with no FPU.
+# The values are AMPLITUDE * sin in Q8.8 fixed point.
+SIN_TABLE = array("h", [int(AMPLITUDE * 256 * math.sin(2 * math.pi * i / 256)) for i in range(256)])
+
+# How far along the table each column is, in Q8.8 table steps.
+PHASE_STEP_Q8 = (CYCLES * 256 * 256) // (COLS + 1)
+COL_PHASES_Q8 = array("i", [x * PHASE_STEP_Q8 for x in range(COLS + 1)])
 
 # The flags we have
 FLAGS = ["pan", "pride"]
 
+# The pallette for each flag, in the same order as FLAGS
+PALETTES = [
+    # pansexual pride flag
+    [
+        (0, 0, 0),       # 0 Black
+        (255, 255, 255), # 1 White
+        (226, 28, 208),  # 2 Magenta
+        (181, 44, 169),  # 3 Magenta shade
+        (255, 245, 39),  # 4 Yellow
+        (218, 211, 58),  # 5 Yellow shade
+        (42, 195, 255),  # 6 Cyan
+        (55, 169, 214)   # 7 Cyan shade
+    ],
+    # traditional pride flag
+    [
+        (0, 0, 0),       # 0 Black
+        (255, 255, 255), # 1 White
+        (234, 53, 53),   # 2 Red
+        (202, 21, 21),   # 3 Red shade
+        (234, 158, 53),  # 4 Orange
+        (202, 127, 21),  # 5 Orange shade
+        (234, 209, 53),  # 6 Yellow
+        (202, 178, 21),  # 7 Yellow shade
+        (53, 234, 56),   # 8 Green
+        (21, 202, 25),   # 9 Green shade
+        (24, 69, 166),   # 10 Blue
+        (26, 61, 137),   # 11 Blue shade
+        (115, 31, 179),  # 12 Purple 
+        (98, 37, 144)    # 13 Purple shade
+    ]
+]
+
+# The light/dark pen pairs for each strip, flattened
+STRIP_PENS = [
+    bytearray([
+        2, 3, # Magenta
+        4, 5, # Yellow
+        6, 7  # Cyan
+    ]),
+    bytearray([
+        2, 3,   # Red
+        4, 5,   # Orange
+        6, 7,   # Yellow
+        8, 9,   # Green
+        10, 11, # Blue
+        12, 13  # Purple
+    ])
+]
+STRIP_HEIGHTS = [FLAG_HEIGHT // (len(pens) // 2) for pens in STRIP_PENS]
+
 def load_config(file_name = "config.json"):
     with open(file_name, "r") as f:
         import json
@@ -96,173 +183,318 @@ def load_config(file_name = "config.json"):
     
     return (flag, title, subtitle, code)
 
-def frange(start, stop, step):
-    x = start
-    yield x
-    while True:
-        x += step
-        yield x
-        if x > stop:
-            yield stop
-            break
-        
-def draw_flag(tick: float, color_list: list[list[int]], height_per_strip: int):
-    offset = tick / 200
-    col_offsets = [
-        int(15 * weight * (math.sin(offset + x)))
-        for x, weight in zip(frange(0, FOUR_PI, FOUR_PI / (COLS + 1)), WEIGHTS)
-    ]
-    
-    for row, colors in enumerate(color_list):
-        for col in range(COLS):        
-            p0 = (col * COL_WIDTH, (row * height_per_strip) + col_offsets[col] + 30)
-            p1 = (p0[0] + COL_WIDTH, (row * height_per_strip) + col_offsets[col + 1] + 30)
-            p2 = (p1[0], p1[1] + height_per_strip)
-            p3 = (p0[0], p0[1] + height_per_strip)
-            m = p0[1] - p1[1]
-            if m < -2:
-                display.set_pen(colors[1])
-            else:  
-                display.set_pen(colors[0])
-                
-            display.polygon([p0, p1, p2, p3])
+# Filled in by draw_flag every frame, allocated once here so the
+# render loop doesn't feed the GC.
+_COL_OFFSETS = array("i", [0] * (COLS + 1))
+
+# Neighbouring columns with the same shade are drawn together as a run.
+# These hold where each run ends, whether it's the dark shade and the
+# lowest and highest offsets along it.
+_RUN_ENDS = bytearray(COLS)
+_RUN_SHADES = bytearray(COLS)
+_RUN_LOW = array("i", [0] * COLS)
+_RUN_HIGH = array("i", [0] * COLS)
+
+# A run is normally one polygon. When the body between its lowest top
+# point and highest bottom point is at least this tall it's filled as
+# a rectangle instead, with the sloped wedges above and below drawn as
+# polygons. Below this the two extra draw calls cost more than they save.
+RUN_BODY_MIN = 50
+
+# A run with n edge points (one more than its columns) needs a polygon
+# with 2n points. Keep a list for each size so the render loop only
+# swaps the points inside them.
+_POLY_POINTS = [[None] * (2 * n) for n in range(COLS + 2)]
+
+# The wedges follow one edge for n points and close along the flat top
+# or bottom of the body with two more.
+_WEDGE_POINTS = [[None] * (n + 2) for n in range(COLS + 2)]
+
+# Every point along each edge between strips for the current frame.
+# The bottom of one strip is the top of the next so they share points.
+_EDGE_POINTS = [None] * ((max(len(pens) // 2 for pens in STRIP_PENS) + 1) * (COLS + 1))
+
+# Bind the display methods once so the viper loop and frame() don't
+# have to look them up on every call.
+_set_pen = display.set_pen
+_polygon = display.polygon
+_rectangle = display.rectangle
+_set_font = display.set_font
+_text = display.text
+_update = display.update
+
+@micropython.viper
+def _emit(offsets: ptr32, pens: ptr8, n_rows: int, strip_h: int):
+    """
+    Draw the strips from the pre-computed column offsets. `pens` holds
+    the light/dark pen pair for each row, flattened.
+    """
+    cols = int(COLS)
+    cw = int(COL_WIDTH)
+    ends = ptr8(_RUN_ENDS)
+    shades = ptr8(_RUN_SHADES)
+    lows = ptr32(_RUN_LOW)
+    highs = ptr32(_RUN_HIGH)
+    body_min = int(RUN_BODY_MIN)
+
+    # The shade only depends on the slope, so the runs are the same
+    # for every row.
+    n_runs = 0
+    for col in range(cols):
+        # Dark when the slope is steeper than -2, taken from the sign bit
+        shade = ((offsets[col] - offsets[col + 1] + 2) >> 31) & 1
+        if n_runs == 0 or shades[n_runs - 1] != shade:
+            shades[n_runs] = shade
+            lows[n_runs] = offsets[col]
+            highs[n_runs] = offsets[col]
+            n_runs += 1
+        ends[n_runs - 1] = col + 1
+        if offsets[col + 1] < lows[n_runs - 1]:
+            lows[n_runs - 1] = offsets[col + 1]
+        if offsets[col + 1] > highs[n_runs - 1]:
+            highs[n_runs - 1] = offsets[col + 1]
+
+    edges = _EDGE_POINTS
+    for edge in range(n_rows + 1):
+        y = edge * strip_h + int(FLAG_TOP)
+        base = edge * (cols + 1)
+        for col in range(cols + 1):
+            edges[base + col] = (col * cw, y + offsets[col])
+
+    for row in range(n_rows):
+        y = row * strip_h + int(FLAG_TOP)
+        top = row * (cols + 1)
+        bottom = top + cols + 1
+        start = 0
+        for run in range(n_runs):
+            end = ends[run]
+            n = end - start + 1
+            x0 = start * cw
+            x1 = end * cw
+            # The body of the run, below its lowest top point and above
+            # its highest bottom point
+            body_top = y + highs[run]
+            body_bottom = y + lows[run] + strip_h
+            _set_pen(pens[row * 2 + shades[run]])
+
+            # Polygons leave out their top row and fill their bottom and
+            # right edges, so the rectangles are shifted to line up.
+            if highs[run] == lows[run]:
+                # Flat, so the whole run is the body
+                _rectangle(x0, body_top + 1, x1 - x0 + 1, strip_h)
+
+            elif body_bottom - body_top < body_min:
+                # Along the top edge and back along the bottom
+                points = _POLY_POINTS[n]
+                i = 0
+                for col in range(start, end + 1):
+                    points[i] = edges[top + col]
+                    points[2 * n - 1 - i] = edges[bottom + col]
+                    i += 1
+                _polygon(points)
+
+            else:
+                _rectangle(x0, body_top + 1, x1 - x0 + 1, body_bottom - body_top)
+
+                # The sloped wedges above and below the body
+                points = _WEDGE_POINTS[n]
+                i = 0
+                for col in range(start, end + 1):
+                    points[i] = edges[top + col]
+                    i += 1
+                points[n] = (x1, body_top)
+                points[n + 1] = (x0, body_top)
+                _polygon(points)
+
+                i = 0
+                for col in range(start, end + 1):
+                    points[i] = edges[bottom + col]
+                    i += 1
+                points[n] = (x1, body_bottom)
+                points[n + 1] = (x0, body_bottom)
+                _polygon(points)
+            start = end
+
+def draw_flag(tick: int, pens: bytearray, height_per_strip: int):
+    # tick / 200 radians is roughly tick / 5 table steps
+    phase = ((tick // 5) & 0xFF) << 8
+    for x in range(COLS + 1):
+        sin = SIN_TABLE[((phase + COL_PHASES_Q8[x]) >> 8) & 0xFF]
+        _COL_OFFSETS[x] = (WEIGHTS_Q8[x] * sin) >> 16
+    _emit(_COL_OFFSETS, pens, len(pens) // 2, height_per_strip)
             
-def text_centered(text: str, x: int, y: int, scale: int = 1, shadow: int = 5):
+def layout_text(text: str, x: int, y: int, scale: int = 1, shadow: int = 5):
     """
-    Place some text with a "shadow"
+    Work out where some centered text goes. The labels never change
+    so this is only done once, not every frame.
     """
     display.set_font("bitmap8")
     text_width = display.measure_text(text, scale, 1)
     text_x, text_y = x - (text_width // 2), y - ( (8 * scale) // 2 )
-    display.set_pen(0)
-    display.text(text, text_x + shadow, text_y + shadow, scale = scale, spacing = 1)
-    display.set_pen(1)
-    display.text(text, text_x, text_y, scale = scale, spacing = 1)
+    return (text, text_x, text_y, scale, shadow)
+
+@micropython.native
+def text_centered(labels: tuple):
+    """
+    Place some text from layout_text with a "shadow"
+    """
+    _set_font("bitmap8")
+    for text, text_x, text_y, scale, shadow in labels:
+        _set_pen(0)
+        _text(text, text_x + shadow, text_y + shadow, scale = scale, spacing = 1)
+        _set_pen(1)
+        _text(text, text_x, text_y, scale = scale, spacing = 1)
     
-def swap_pallette(mode):
+def swap_pallette(flag: int):
     """
-    Set up the pallette for the the flag and the light/dark
-    pairs for the strips.
+    Set up the pallette for the the flag and return the light/dark
+    pairs and height for the strips.
     """
-    if mode == "pan":
-        # pansexual pride flag
-        display.set_palette([
-            (0, 0, 0),       # 0 Black
-            (255, 255, 255), # 1 White
-            (226, 28, 208),  # 2 Magenta
-            (181, 44, 169),  # 3 Magenta shade
-            (255, 245, 39),  # 4 Yellow
-            (218, 211, 58),  # 5 Yellow shade
-            (42, 195, 255),  # 6 Cyan
-            (55, 169, 214)   # 7 Cyan shade
-        ])
-        colors = [
-            [2, 3], # Magenta
-            [4, 5], # Yellow
-            [6, 7]  # Cyan
-        ]
-        
-    elif mode == "pride":
-        # traditional pride flag
-        display.set_palette([
-            (0, 0, 0),       # 0 Black
-            (255, 255, 255), # 1 White
-            (234, 53, 53),   # 2 Red
-            (202, 21, 21),   # 3 Red shade
-            (234, 158, 53),  # 4 Orange
-            (202, 127, 21),  # 5 Orange shade
-            (234, 209, 53),  # 6 Yellow
-            (202, 178, 21),  # 7 Yellow shade
-            (53, 234, 56),   # 8 Green
-            (21, 202, 25),   # 9 Green shade
-            (24, 69, 166),   # 10 Blue
-            (26, 61, 137),   # 11 Blue shade
-            (115, 31, 179),  # 12 Purple 
-            (98, 37, 144)    # 13 Purple shade
-        ])
-        colors = [
-            [2, 3],   # Red
-            [4, 5],   # Orange
-            [6, 7],   # Yellow
-            [8, 9],   # Green
-            [10, 11], # Blue
-            [12, 13]  # Purple
-        ]
-        
-    # Return the list of colors and the height of a strip
-    return (colors, 180 // len(colors))
+    display.set_palette(PALETTES[flag])
+    return (STRIP_PENS[flag], STRIP_HEIGHTS[flag])
 
-def qr_code(code: QRCode, fg, bg, width: int = 200):
+def layout_qr_code(code: QRCode, width: int = 200):
+    """
+    Turn the QR code into a list of rectangles, one for each horizontal
+    run of modules. The code never changes so this is only done once.
+    """
     w, h = code.get_size()
     dot_size = width // w
     # Place in the center of the screen
     left = (WIDTH // 2) - ((dot_size * w) // 2)
     top = (HEIGHT // 2) - ((dot_size * h) // 2)
     
-    display.set_pen(fg)
-    display.rectangle(left, top, dot_size * w, dot_size * h)
-    display.set_pen(bg)
-    for x in range(w):
-        for y in range(h):
-            if code.get_module(x, y):
-                display.rectangle(left + x * dot_size, top + y * dot_size, dot_size, dot_size)
+    rects = [left, top, dot_size * w, dot_size * h]
+    get_module = code.get_module
+    for y in range(h):
+        x = 0
+        while x < w:
+            if get_module(x, y):
+                x0 = x
+                while x < w and get_module(x, y):
+                    x += 1
+                rects += [left + x0 * dot_size, top + y * dot_size, (x - x0) * dot_size, dot_size]
+            else:
+                x += 1
+    return array("h", rects)
+
+@micropython.native
+def qr_code(rects: array, fg, bg):
+    """
+    Draw the rectangles from layout_qr_code, the first one is the background.
+    """
+    _set_pen(fg)
+    _rectangle(rects[0], rects[1], rects[2], rects[3])
+    _set_pen(bg)
+    for i in range(4, len(rects), 4):
+        _rectangle(rects[i], rects[i + 1], rects[i + 2], rects[i + 3])
 
 flag, name, subtitle, qr = load_config()
+labels = (
+    layout_text(name, WIDTH // 2, (HEIGHT // 2) - 10, 10),
+    layout_text(subtitle, WIDTH // 2, (HEIGHT // 2) + 40, 3, 2)
+)
+qr_rects = layout_qr_code(qr)
 mode = "run"
-prev = time.ticks_ms() - 1
+prev = _ticks_ms() - 1
+tick = prev
+last_button_poll = prev
+last_lux_poll = prev
+lux_smooth = lux.read_u16()
+backlight_level = -1
 
-strip_colors, strip_height = swap_pallette(FLAGS[flag])
+strip_colors, strip_height = swap_pallette(flag)
 show_fps = False
 show_qr = False
+fps_shown = False
 
-gc.collect()
-while True: # Main loop
-    now = time.ticks_ms()
-        
-    if mode == "run":
-        if button_a.read():
-            mode = "pause"
-            
-    elif mode == "pause":
-        if button_a.read():
-            mode = "run"
-        
-    if button_up.read():
-        flag  = flag + 1 if flag != len(FLAGS) - 1 else 0
-        strip_colors, strip_height = swap_pallette(FLAGS[flag])
-        
-    if button_down.read():
-        flag  = flag - 1 if flag != 0 else len(FLAGS) - 1 
-        strip_colors, strip_height = swap_pallette(FLAGS[flag])
-        
-    if button_b.read():
-        show_qr = not show_qr
-        
-    if button_c.read():
-        show_fps = not show_fps
+@micropython.native
+def frame(now: int):
+    """
+    Handle the buttons and draw one frame.
+    """
+    global mode, flag, strip_colors, strip_height, show_qr, show_fps, tick, prev
+    global last_button_poll, fps_shown, last_lux_poll, lux_smooth, backlight_level
+    
+    pressed = False
+    if _ticks_diff(now, last_button_poll) > BUTTON_POLL_MS:
+        last_button_poll = now
+
+        if mode == "run":
+            if button_a.read():
+                mode = "pause"
+                pressed = True
+
+        elif mode == "pause":
+            if button_a.read():
+                mode = "run"
+                pressed = True
+
+        if button_up.read():
+            flag  = flag + 1 if flag != len(FLAGS) - 1 else 0
+            strip_colors, strip_height = swap_pallette(flag)
+            pressed = True
+
+        if button_down.read():
+            flag  = flag - 1 if flag != 0 else len(FLAGS) - 1 
+            strip_colors, strip_height = swap_pallette(flag)
+            pressed = True
+
+        if button_b.read():
+            show_qr = not show_qr
+            pressed = True
+
+        if button_c.read():
+            show_fps = not show_fps
+            pressed = True
+
+        # Collect while the user is busy pressing buttons, rather than
+        # letting the GC kick in halfway through the animation.
+        if pressed:
+            gc.collect()
     
+    if _ticks_diff(now, last_lux_poll) > LUX_POLL_MS:
+        last_lux_poll = now
+        lux_smooth = (lux_smooth * 7 + lux.read_u16()) >> 3
+        level = min(7, lux_smooth // 500)
+        if level != backlight_level:
+            backlight_level = level
+            display.set_backlight(BACKLIGHT_LEVELS[level])
+
     if mode == "run":
-        tick = time.ticks_ms()
+        tick = now
+    elif not pressed:
+        # Paused and nothing has changed, the last frame is still showing.
+        # Keep prev moving so the fps counter is right on the next redraw.
+        prev = now
+        _sleep_ms(PAUSE_SLEEP_MS)
+        return
         
-    display.set_pen(0)
-    display.clear()
+    # Only the flag band and the fps counter ever change
+    _set_pen(0)
+    _rectangle(0, BAND_TOP, WIDTH, BAND_HEIGHT)
+    if show_fps or fps_shown:
+        _rectangle(0, 0, WIDTH, BAND_TOP)
+        fps_shown = show_fps
     draw_flag(tick, strip_colors, strip_height)
     
     if show_qr:
-        qr_code(qr, 1, 0)
+        qr_code(qr_rects, 1, 0)
     else:
-        text_centered(name, WIDTH // 2, (HEIGHT // 2) - 10, 10)
-        text_centered(subtitle, WIDTH // 2, (HEIGHT // 2) + 40, 3, 2)
+        text_centered(labels)
 
     if show_fps:
         fps = 1000 // (now - prev)
-        display.set_font("bitmap6")
-        display.set_pen(1)
-        display.text(str(fps) + " fps", 0, 0)
+        _set_font("bitmap6")
+        _set_pen(1)
+        _text(str(fps) + " fps", 0, 0)
             
     prev = now
-    display.update()
-    
-    light = min(0.5, lux.read_u16() / 7000)
-    display.set_backlight(0.5 + light)
+    _update()
+
+display.set_pen(0)
+display.clear()
 
+gc.collect()
+while True: # Main loop
+    frame(_ticks_ms())